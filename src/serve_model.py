@@ -1,72 +1,435 @@
 """
 Flask API of the SMS Spam detection model model.
 """
+import atexit
+import hashlib
 import joblib
+import logging
+import logging.handlers
 import os
-import urllib.request
 import tarfile
+import shutil
+import subprocess
 import sys
+import threading
+import time
+import queue
+from collections import OrderedDict
+import numpy as np
+import orjson
+import scipy.sparse
+import urllib3
 from flask import Flask, jsonify, request, make_response
 from flasgger import Swagger
-import pandas as pd
 import psutil
 
-from text_preprocessing import prepare, _extract_message_len, _text_process
+from text_preprocessing import prepare, load_preprocessor, _extract_message_len, _text_process
+
+# Preprocessors trained by running text_preprocessing.py as a script pickle
+# these functions under __main__, which is gunicorn rather than this module
+# when served by it, so expose them there for unpickling.
+import __main__
+__main__._text_process = _text_process
+__main__._extract_message_len = _extract_message_len
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Path to version.txt relative to this file
+VERSION_FILE = os.path.join(PROJECT_ROOT, 'version.txt')
 MODEL_DIR = os.environ.get('MODEL_DIR', 'output')
 MODEL_URL = os.environ.get('MODEL_URL')
 MODEL_FILE = os.path.join(MODEL_DIR, 'model.joblib')
 PREPROCESSOR_FILE = os.path.join(MODEL_DIR, 'preprocessor.joblib')
+MODEL_FILE_NAMES = (os.path.basename(MODEL_FILE), os.path.basename(PREPROCESSOR_FILE))
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+# Extracted files are written under this suffix until the archive is complete
+PARTIAL_SUFFIX = '.part'
+# Messages up to one standard SMS are used as their own cache key
+SHORT_MESSAGE_LEN = 160
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 1024))
+BATCH_MAX = int(os.environ.get('BATCH_MAX', 32))
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 5))
+BATCH_TIMEOUT_SECONDS = 10.0
+METRICS_TTL_SECONDS = 1.0
+# Clients already have the message, set to false to leave it out of responses
+RESPONSE_INCLUDE_SMS = os.environ.get('RESPONSE_INCLUDE_SMS', 'true').lower() == 'true'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+
+# Request threads only enqueue log records, a listener thread does the I/O
+logger = logging.getLogger(__name__)
+log_queue = queue.Queue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log_listener = None
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.setLevel(LOG_LEVEL)
+
+# Loaded once by load_model() instead of on every request
+MODEL = None
+
+# LRU cache of predictions, shared by all threads of a worker
+prediction_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_hits = 0
+cache_misses = 0
+
+# Requests waiting to be predicted together by the batcher thread
+batch_queue = queue.Queue()
+batcher_thread = None
+batcher_lock = threading.Lock()
+# Cache misses still being preprocessed, i.e. rows about to be queued
+batch_preparing = 0
+
+# Last /proc reading served by /metrics, refreshed at most once per second
+metrics_lock = threading.Lock()
+metrics_sample = None
+metrics_sampled_at = 0.0
+
+# Pooled HTTP client, reuses keep-alive connections across downloads
+http = urllib3.PoolManager(maxsize=4)
+
+def _start_log_listener():
+    global log_listener
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+
+def _stop_log_listener():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+_start_log_listener()
+# Stop the listener across fork so no thread holds the queue or stderr locks
+# and no queued records are copied into the child; each side then restarts it
+os.register_at_fork(
+    before=_stop_log_listener,
+    after_in_parent=_start_log_listener,
+    after_in_child=_start_log_listener
+)
+atexit.register(_stop_log_listener)
 
 app = Flask(__name__)
 swagger = Swagger(app)
 
+def extract_tarball(tar, path):
+    """
+    Extracts the model files from a streamed tarball, copying each one to a
+    PARTIAL_SUFFIX file through a fixed DOWNLOAD_CHUNK_SIZE buffer instead of
+    reading it whole; install_model_files() moves them into place.
+    Anything else in the release (READMEs, directories, links) is skipped, so
+    only trusted, fixed file names are ever written.
+    """
+    for member in tar:
+        name = os.path.normpath(member.name)
+        if not member.isfile() or name not in MODEL_FILE_NAMES:
+            continue
+        # A streamed member must be copied before moving to the next one
+        target = os.path.join(path, name + PARTIAL_SUFFIX)
+        with tar.extractfile(member) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=DOWNLOAD_CHUNK_SIZE)
+
+def _extract_with_pigz(pigz, resp):
+    """
+    Extracts the streamed tarball with gzip decompression offloaded to pigz.
+    Errors raised while downloading on the feeder thread are re-raised here.
+    """
+    proc = subprocess.Popen([pigz, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feed_errors = []
+
+    def feed():
+        try:
+            for chunk in resp.stream(DOWNLOAD_CHUNK_SIZE):
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # pigz exited early, its return code is checked below
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|", bufsize=DOWNLOAD_CHUNK_SIZE) as tar:
+            extract_tarball(tar, MODEL_DIR)
+        # Drain trailing padding so pigz and the feeder can finish
+        while proc.stdout.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+        feeder.join()
+        returncode = proc.wait()
+    except Exception as e:
+        # A failed download usually surfaces first as a truncated tar stream
+        proc.kill()
+        feeder.join()
+        if feed_errors:
+            raise feed_errors[0] from e
+        raise
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    if feed_errors:
+        raise feed_errors[0]
+    if returncode != 0:
+        raise RuntimeError(f"pigz exited with code {returncode}")
+
+def install_model_files():
+    """
+    Moves fully extracted model files from their partial names into place.
+    """
+    for name in MODEL_FILE_NAMES:
+        partial = os.path.join(MODEL_DIR, name + PARTIAL_SUFFIX)
+        if os.path.exists(partial):
+            os.replace(partial, os.path.join(MODEL_DIR, name))
+
+def discard_partial_files():
+    """
+    Removes partial model files left behind by an interrupted extraction.
+    """
+    for name in MODEL_FILE_NAMES:
+        try:
+            os.remove(os.path.join(MODEL_DIR, name + PARTIAL_SUFFIX))
+        except FileNotFoundError:
+            pass
+
+def model_files_present():
+    """
+    Checks for both model files in a single stat pass.
+    """
+    try:
+        os.stat(MODEL_FILE)
+        os.stat(PREPROCESSOR_FILE)
+    except OSError:
+        return False
+    return True
+
 def download_and_extract_model():
     """
     Downloads and extracts the model if not already present.
     """
     try:
-        os.makedirs(MODEL_DIR, exist_ok=True)
-        
         # Check if files exist (local cache)
-        if os.path.exists(MODEL_FILE) and os.path.exists(PREPROCESSOR_FILE):
-            print(f"Model files found in {MODEL_DIR}, skipping download.")
+        if model_files_present():
+            logger.info("Model files found in %s, skipping download.", MODEL_DIR)
             return
 
-        print("Model files not found locally.")
+        logger.info("Model files not found locally.")
+        os.makedirs(MODEL_DIR, exist_ok=True)
 
         # If no local files, check for MODEL_URL
         if not MODEL_URL:
-            print("ERROR: MODEL_URL environment variable is not set.", file=sys.stderr)
-            print("Please set MODEL_URL to point to a model-release.tar.gz file.", file=sys.stderr)
+            logger.error("MODEL_URL environment variable is not set.")
+            logger.error("Please set MODEL_URL to point to a model-release.tar.gz file.")
             sys.exit(1) 
 
-        print(f"Downloading model from {MODEL_URL}...")
-        
-        # Temp path for the downloaded tarball
-        tmp_tar_path = os.path.join(MODEL_DIR, 'model-release.tar.gz')
-        
-        urllib.request.urlretrieve(MODEL_URL, tmp_tar_path)
-        print("Download complete. Extracting...")
-
-        # Extract the tarball
-        with tarfile.open(tmp_tar_path, "r:gz") as tar:
-            tar.extractall(path=MODEL_DIR)
-        
-        print(f"Extraction complete. Model files are in {MODEL_DIR}.")
-
-        # Clean up the downloaded tarball
-        os.remove(tmp_tar_path)
-
-        if not os.path.exists(MODEL_FILE) or not os.path.exists(PREPROCESSOR_FILE):
-            print(f"ERROR: Expected model files not found after extraction.", file=sys.stderr)
+        logger.info("Downloading model from %s...", MODEL_URL)
+
+        # Stream the tarball straight into the extractor, no temp file on disk
+        resp = http.request('GET', MODEL_URL, preload_content=False)
+        try:
+            if resp.status != 200:
+                logger.error("Model download failed with HTTP %s.", resp.status)
+                sys.exit(1)
+
+            pigz = shutil.which('pigz')
+            if pigz:
+                _extract_with_pigz(pigz, resp)
+            else:
+                with tarfile.open(fileobj=resp, mode="r|gz", bufsize=DOWNLOAD_CHUNK_SIZE) as tar:
+                    extract_tarball(tar, MODEL_DIR)
+
+            # Only replace the real files once the whole archive was read, so
+            # a dropped connection never leaves truncated model files behind
+            install_model_files()
+        finally:
+            resp.release_conn()
+            discard_partial_files()
+
+        logger.info("Download and extraction complete. Model files are in %s.", MODEL_DIR)
+
+        if not model_files_present():
+            logger.error("Expected model files not found after extraction.")
             sys.exit(1)
 
     except Exception as e:
-        print(f"Error during model download/extraction: {e}", file=sys.stderr)
+        logger.error("Error during model download/extraction: %s", e)
         sys.exit(1)
 
+def load_model():
+    """
+    Loads the model into memory once so requests don't hit the disk.
+    Workers share it only through copy-on-write after `gunicorn --preload`
+    forks them; sklearn trees copy their arrays on unpickling, so mmap_mode
+    would not help.
+    """
+    global MODEL
+    MODEL = joblib.load(MODEL_FILE)
+
+def read_version():
+    """
+    Reads version.txt, returning the version and an error message if it failed.
+    """
+    try:
+        with open(VERSION_FILE, 'r') as f:
+            return f.read().strip(), None
+    except Exception as e:
+        return "unknown", str(e)
+
+def get_cache_key(message):
+    """
+    Returns short messages as-is, or a compact 16-byte BLAKE2b digest of
+    longer ones, to key the cache. A str key can never equal a bytes digest,
+    so a short message cannot collide with a long one.
+    """
+    if len(message) <= SHORT_MESSAGE_LEN:
+        return message
+    return hashlib.blake2b(message.encode('utf-8'), digest_size=16).digest()
+
+def get_from_cache(cache_key):
+    """
+    Returns the cached prediction for the key, or None on a miss.
+    """
+    global cache_hits, cache_misses
+    with cache_lock:
+        prediction = prediction_cache.get(cache_key)
+        if prediction is None:
+            cache_misses += 1
+            return None
+        cache_hits += 1
+        prediction_cache.move_to_end(cache_key)
+        return prediction
+
+def add_to_cache(cache_key, prediction):
+    """
+    Stores a prediction, evicting the least recently used entry when full.
+    """
+    with cache_lock:
+        prediction_cache[cache_key] = prediction
+        prediction_cache.move_to_end(cache_key)
+        if len(prediction_cache) > CACHE_MAX_SIZE:
+            prediction_cache.popitem(last=False)
+
+def get_cache_stats():
+    """
+    Returns a snapshot of this worker's prediction cache statistics.
+    """
+    with cache_lock:
+        hits, misses, size = cache_hits, cache_misses, len(prediction_cache)
+    lookups = hits + misses
+    return {
+        "size": size,
+        "max_size": CACHE_MAX_SIZE,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0
+    }
+
+def _batch_worker():
+    """
+    Takes whatever requests are queued, up to BATCH_MAX, and runs them through
+    a single model.predict call. It only waits (up to BATCH_WINDOW_MS) for more
+    while other cache misses are still being preprocessed, so a lone request
+    is predicted straight away.
+    """
+    while True:
+        items = [batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+        while len(items) < BATCH_MAX:
+            try:
+                items.append(batch_queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or batch_preparing == 0:
+                break
+            try:
+                items.append(batch_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        rows = [item['features'] for item in items]
+        try:
+            if scipy.sparse.issparse(rows[0]):
+                X_batch = scipy.sparse.vstack(rows)
+            else:
+                X_batch = np.vstack(rows)
+            # tolist() turns numpy scalars into plain Python values in one pass
+            predictions = MODEL.predict(X_batch).tolist()
+        except Exception as e:
+            for item in items:
+                item['error'] = e
+                item['done'].set()
+            continue
+
+        for item, prediction in zip(items, predictions):
+            item['result'] = prediction
+            item['done'].set()
+
+def predict_batched(message):
+    """
+    Preprocesses one message and queues it for the batcher, waiting at most
+    BATCH_TIMEOUT_SECONDS for its prediction. Returns None if the message
+    could not be preprocessed.
+    """
+    global batcher_thread, batch_preparing
+    # Started lazily so each forked worker gets its own thread, and restarted
+    # should it ever die
+    if batcher_thread is None or not batcher_thread.is_alive():
+        with batcher_lock:
+            if batcher_thread is None or not batcher_thread.is_alive():
+                batcher_thread = threading.Thread(target=_batch_worker, daemon=True)
+                batcher_thread.start()
+
+    with batcher_lock:
+        batch_preparing += 1
+    try:
+        features = prepare(message)
+    finally:
+        with batcher_lock:
+            batch_preparing -= 1
+    if features is None:
+        return None
+
+    item = {'features': features, 'done': threading.Event()}
+    batch_queue.put(item)
+    if not item['done'].wait(BATCH_TIMEOUT_SECONDS):
+        raise TimeoutError("Timed out waiting for the batched prediction")
+    if 'error' in item:
+        raise item['error']
+    return item['result']
+
+def get_metrics_body():
+    """
+    Returns the metrics text, re-sampling psutil at most once per
+    METRICS_TTL_SECONDS so concurrent scrapes share one reading.
+    """
+    global metrics_sample, metrics_sampled_at
+    with metrics_lock:
+        now = time.monotonic()
+        if metrics_sample is None or now - metrics_sampled_at >= METRICS_TTL_SECONDS:
+            mem = psutil.virtual_memory()
+            metrics_sample = (
+                f"backend_cpu_usage_percent {psutil.cpu_percent()}\n"
+                f"backend_memory_max_bytes {mem.total}\n"
+                f"backend_memory_used_bytes {mem.used}\n"
+            )
+            metrics_sampled_at = now
+        return metrics_sample
+
+# Runs at import so `gunicorn --preload` loads the model and preprocessor
+# once in the master
+download_and_extract_model()
+load_model()
+if load_preprocessor() is None:
+    logger.error("Preprocessor file not found at %s.", PREPROCESSOR_FILE)
+    sys.exit(1)
+VERSION, VERSION_ERROR = read_version()
+
 @app.route('/metrics', methods=['GET'])
 def metrics():
     """
@@ -76,13 +439,7 @@ def metrics():
       200:
         description: "Service metrics."
     """
-    mem = psutil.virtual_memory()
-    body = (
-        f"backend_cpu_usage_percent {psutil.cpu_percent()}\n"
-        f"backend_memory_max_bytes {mem.total}\n"
-        f"backend_memory_used_bytes {mem.used}\n"
-    )
-    response = make_response(body, 200)
+    response = make_response(get_metrics_body(), 200)
     response.mimetype = "text/plain"
     return response
 
@@ -111,21 +468,55 @@ def predict():
     """
     input_data = request.get_json()
     sms = input_data.get('sms')
-    
-    processed_sms = prepare(sms)
-    if processed_sms is None:
-        return jsonify({"error": "Failed to process SMS"}), 500
-        
-    model = joblib.load(MODEL_FILE) # Load from the configurable path
-    prediction = model.predict(processed_sms)[0]
+
+    cache_key = get_cache_key(sms)
+    prediction = get_from_cache(cache_key)
+    if prediction is None:
+        try:
+            prediction = predict_batched(sms)
+        except TimeoutError as e:
+            logger.error("Prediction failed: %s", e)
+            return jsonify({"error": "Prediction timed out"}), 503
+        if prediction is None:
+            return jsonify({"error": "Failed to process SMS"}), 500
+
+        add_to_cache(cache_key, prediction)
     
     res = {
         "result": prediction,
         "classifier": "decision tree",
-        "sms": sms
     }
-    print(res)
-    return jsonify(res)
+    if RESPONSE_INCLUDE_SMS:
+        res["sms"] = sms
+    logger.info("Prediction: %s", res)
+    return app.response_class(
+        orjson.dumps(res),
+        mimetype='application/json'
+    )
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """
+    Get prediction cache statistics of the worker serving the request.
+    ---
+    responses:
+      200:
+        description: "Prediction cache statistics."
+        schema:
+          type: object
+          properties:
+            size:
+              type: integer
+            max_size:
+              type: integer
+            hits:
+              type: integer
+            misses:
+              type: integer
+            hit_rate:
+              type: number
+    """
+    return jsonify(get_cache_stats())
 
 @app.route('/version', methods=['GET'])
 def get_version():
@@ -142,19 +533,12 @@ def get_version():
               type: string
               example: "v1.1.0"
     """
-    try:
-        # Path to version.txt relative to this file
-        version_file = os.path.join(PROJECT_ROOT, 'version.txt')
-        with open(version_file, 'r') as f:
-            version = f.read().strip()
-        return jsonify({"version": version})
-    except Exception as e:
-        return jsonify({"version": "unknown", "error": str(e)}), 500
+    if VERSION_ERROR is not None:
+        return jsonify({"version": VERSION, "error": VERSION_ERROR}), 500
+    return jsonify({"version": VERSION})
 
 if __name__ == '__main__':
-
-    download_and_extract_model()     
     # Get port from environment variable, default to 8081
     app_port = int(os.environ.get('APP_PORT', 8081))
-    app.run(host="0.0.0.0", port=app_port, debug=True)
+    app.run(host="0.0.0.0", port=app_port)
     
\ No newline at end of file
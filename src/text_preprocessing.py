@@ -2,10 +2,10 @@
 Preprocess the data to be trained by the learning algorithm.
 """
 
-import pandas as pd
 import numpy as np
 import os # Import os
 import string
+import threading
 import nltk
 from nltk.corpus import stopwords
 from nltk.stem import SnowballStemmer
@@ -20,7 +20,18 @@ MODEL_DIR = os.environ.get('MODEL_DIR', 'output')
 PREPROCESSOR_FILE = os.path.join(MODEL_DIR, 'preprocessor.joblib')
 PREPROCESSED_DATA_FILE = os.path.join(MODEL_DIR, 'preprocessed_data.joblib')
 
+# Built once instead of on every word of every message
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+STEMMER = SnowballStemmer('english')
+STOPWORDS = frozenset(stopwords.words('english'))
+
+# Loaded once by load_preprocessor(), shared by all requests
+_preprocessor = None
+_preprocessor_lock = threading.Lock()
+
 def _load_data():
+    # Imported here so serving, which only needs prepare(), doesn't load pandas
+    import pandas as pd
     messages = pd.read_csv(
         'smsspamcollection/SMSSpamCollection',
         sep='\t',
@@ -35,18 +46,13 @@ def _text_process(data):
     3. remove stop words
     4. return list of clean text words
     '''
-    nopunc = [c for c in data if c not in string.punctuation] #remove punctuations
-    nopunc = ''.join(nopunc)
+    nopunc = data.translate(PUNCTUATION_TABLE) #remove punctuations
 
-    stemmed = ''
-    nopunc = nopunc.split()
-    for i in nopunc:
-        stemmer = SnowballStemmer('english')
-        stemmed += (stemmer.stem(i)) + ' ' # stemming of words
+    stemmed = [STEMMER.stem(word) for word in nopunc.split()] # stemming of words
 
     clean_msgs = [
-        word for word in stemmed.split()
-        if word.lower() not in stopwords.words('english')
+        word for word in stemmed
+        if word.lower() not in STOPWORDS
     ] # remove stopwords
 
     return clean_msgs
@@ -79,18 +85,31 @@ def _preprocess(messages):
     dump(preprocessed_data, PREPROCESSED_DATA_FILE)
     return preprocessed_data
 
+def load_preprocessor():
+    # Load preprocessor from the configurable path, returns None if missing;
+    # callers decide how to report that
+    global _preprocessor
+    with _preprocessor_lock:
+        if _preprocessor is None:
+            if not os.path.exists(PREPROCESSOR_FILE):
+                return None
+            _preprocessor = load(PREPROCESSOR_FILE)
+        return _preprocessor
+
 def prepare(message):
-    # Load preprocessor from the configurable path
-    if not os.path.exists(PREPROCESSOR_FILE):
-        print(f"Error: Preprocessor file not found at {PREPROCESSOR_FILE}")
-        # Handle error appropriately, e.g., return an error response
-        return None 
-    preprocessor = load(PREPROCESSOR_FILE)
+    preprocessor = _preprocessor
+    if preprocessor is None:
+        # Fallback for callers that didn't load it up front
+        preprocessor = load_preprocessor()
+        if preprocessor is None:
+            # Handle error appropriately, e.g., return an error response
+            return None
     return preprocessor.transform([message])
 
 def main():
     version = os.getenv("APP_VERSION", "unknown")
     print(f"Text Preprocessing Module - Version: {version}")
+    import pandas as pd
     messages = _load_data()
     print('\n################### Processed Messages ###################\n')
     with pd.option_context('expand_frame_repr', False):